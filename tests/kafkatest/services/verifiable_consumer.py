@@ -13,9 +13,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import os
 import signal
+import threading
+
+try:
+    from queue import Empty, Queue
+except ImportError:  # Python 2
+    from Queue import Empty, Queue
+
+# Parsing consumer events is the dominant per-line cost in _worker, so prefer
+# a C-accelerated parser when one is available on the test driver: orjson on
+# Python 3 drivers, then ujson, then the stdlib. Only loads() is used in this
+# module, and all three raise ValueError-compatible errors on bad input.
+try:
+    import orjson as json
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
 
 from ducktape.services.background_thread import BackgroundThreadService
 from ducktape.cluster.remoteaccount import RemoteCommandError
@@ -25,6 +42,41 @@ from kafkatest.services.kafka import TopicPartition
 from kafkatest.version import TRUNK
 
 
+# A test only ever sees as many distinct TopicPartitions as the topic has
+# partitions, but the event handlers were constructing a fresh instance per
+# partition per event just to use it as a dict key. Intern them instead so
+# repeated events share one instance per (topic, partition).
+_TOPIC_PARTITION_CACHE = {}
+
+
+def _topic_partition(topic, partition):
+    key = (topic, partition)
+    tp = _TOPIC_PARTITION_CACHE.get(key)
+    if tp is None:
+        tp = _TOPIC_PARTITION_CACHE.setdefault(key, TopicPartition(topic, partition))
+    return tp
+
+
+# Consumed and committed offsets are tracked per topic in partition-indexed
+# lists rather than TopicPartition-keyed dicts: partition ids are small dense
+# ints, so the hot handlers pay a list index instead of a tuple hash per
+# lookup. A slot of None means no offset has been recorded for the partition.
+def _offset_lookup(offsets, topic, partition):
+    partitions = offsets.get(topic)
+    if partitions is None or partition >= len(partitions):
+        return None
+    return partitions[partition]
+
+
+def _offset_store(offsets, topic, partition, offset):
+    partitions = offsets.get(topic)
+    if partitions is None:
+        partitions = offsets[topic] = []
+    if partition >= len(partitions):
+        partitions.extend([None] * (partition + 1 - len(partitions)))
+    partitions[partition] = offset
+
+
 class ConsumerState:
     Dead = 1
     Rebalancing = 3
@@ -32,46 +84,69 @@ class ConsumerState:
 
 
 class ConsumerEventHandler(object):
+    # these attributes are read and written on every consumer event, so keep
+    # instances __dict__-free and attribute access a fixed slot load
+    __slots__ = ("node", "validate", "state", "revoked_count", "assigned_count",
+                 "assignment", "position", "committed", "total_consumed")
 
-    def __init__(self, node):
+    def __init__(self, node, validate=True):
         self.node = node
+        self.validate = validate
         self.state = ConsumerState.Dead
         self.revoked_count = 0
         self.assigned_count = 0
-        self.assignment = []
+        self.assignment = ()
         self.position = {}
         self.committed = {}
         self.total_consumed = 0
 
-    def handle_shutdown_complete(self):
+    def handle_shutdown_complete(self, event=None):
         self.state = ConsumerState.Dead
-        self.assignment = []
+        self.assignment = ()
         self.position = {}
 
     def handle_offsets_committed(self, event):
         if event["success"]:
+            # bind the attributes used per partition to locals; a local load
+            # is a single opcode where each self lookup costs a dict access
+            validate = self.validate
+            positions = self.position
+            committed = self.committed
+            assignment = self.assignment
             for offset_commit in event["offsets"]:
                 topic = offset_commit["topic"]
                 partition = offset_commit["partition"]
-                tp = TopicPartition(topic, partition)
                 offset = offset_commit["offset"]
-                assert tp in self.assignment, "Committed offsets for a partition not assigned"
-                assert self.position[tp] >= offset, "The committed offset was greater than the current position"
-                self.committed[tp] = offset
+                if validate:
+                    position = _offset_lookup(positions, topic, partition)
+                    if _topic_partition(topic, partition) not in assignment:
+                        raise AssertionError("Committed offsets for a partition not assigned")
+                    if position is None or position < offset:
+                        raise AssertionError("The committed offset was greater than the current position")
+                _offset_store(committed, topic, partition, offset)
 
     def handle_records_consumed(self, event):
-        assert self.state == ConsumerState.Joined, "Consumed records should only be received when joined"
-
+        validate = self.validate
+        if validate and self.state != ConsumerState.Joined:
+            raise AssertionError("Consumed records should only be received when joined")
+
+        # local bindings for the hottest loop in the harness (see
+        # handle_offsets_committed)
+        positions = self.position
+        assignment = self.assignment
         for record_batch in event["partitions"]:
-            tp = TopicPartition(topic=record_batch["topic"],
-                                partition=record_batch["partition"])
-            min_offset = record_batch["minOffset"]
+            topic = record_batch["topic"]
+            partition = record_batch["partition"]
             max_offset = record_batch["maxOffset"]
 
-            assert tp in self.assignment, "Consumed records for a partition not assigned"
-            assert tp not in self.position or self.position[tp] == min_offset, \
-                "Consumed from an unexpected offset (%s, %s)" % (str(self.position[tp]), str(min_offset))
-            self.position[tp] = max_offset + 1 
+            if validate:
+                min_offset = record_batch["minOffset"]
+                position = _offset_lookup(positions, topic, partition)
+                if _topic_partition(topic, partition) not in assignment:
+                    raise AssertionError("Consumed records for a partition not assigned")
+                if position is not None and position != min_offset:
+                    raise AssertionError("Consumed from an unexpected offset (%s, %s)" % (position, min_offset))
+            _offset_store(positions, topic, partition, max_offset + 1)
 
         self.total_consumed += event["count"]
 
@@ -83,12 +158,9 @@ class ConsumerEventHandler(object):
     def handle_partitions_assigned(self, event):
         self.assigned_count += 1
         self.state = ConsumerState.Joined
-        assignment = []
-        for topic_partition in event["partitions"]:
-            topic = topic_partition["topic"]
-            partition = topic_partition["partition"]
-            assignment.append(TopicPartition(topic, partition))
-        self.assignment = assignment
+        # a tuple can be handed out by current_assignment without copying
+        self.assignment = tuple(_topic_partition(tp["topic"], tp["partition"])
+                                for tp in event["partitions"])
 
     def handle_kill_process(self, clean_shutdown):
         # if the shutdown was clean, then we expect the explicit
@@ -97,19 +169,13 @@ class ConsumerEventHandler(object):
             self.handle_shutdown_complete()
 
     def current_assignment(self):
-        return list(self.assignment)
+        return self.assignment
 
     def current_position(self, tp):
-        if tp in self.position:
-            return self.position[tp]
-        else:
-            return None
+        return _offset_lookup(self.position, tp.topic, tp.partition)
 
     def last_commit(self, tp):
-        if tp in self.committed:
-            return self.committed[tp]
-        else:
-            return None
+        return _offset_lookup(self.committed, tp.topic, tp.partition)
 
 
 class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
@@ -136,7 +202,12 @@ class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
     def __init__(self, context, num_nodes, kafka, topic, group_id,
                  max_messages=-1, session_timeout_sec=30, enable_autocommit=False,
                  assignment_strategy="org.apache.kafka.clients.consumer.RangeAssignor",
-                 version=TRUNK, stop_timeout_sec=30):
+                 version=TRUNK, stop_timeout_sec=30, validate=True):
+        """
+        :param validate check offset/assignment invariants as events arrive.
+               Enabled by default; disable for pure throughput runs where the
+               per-event checks are unwanted overhead.
+        """
         super(VerifiableConsumer, self).__init__(context, num_nodes)
         self.log_level = "TRACE"
         
@@ -151,19 +222,33 @@ class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
         self.security_config = kafka.security_config.client_config(self.prop_file)
         self.prop_file += str(self.security_config)
         self.stop_timeout_sec = stop_timeout_sec
+        self.validate = validate
 
         self.event_handlers = {}
         self.global_position = {}
         self.global_committed = {}
+        self._global_total_consumed = 0
+        self._max_assigned_count = 0
+        self._start_cmd_cache = {}
+
+        # nodes bucketed by consumer state, kept in sync by the workers as
+        # events arrive so the state queries below need not rescan handlers
+        self._nodes_by_state = {
+            ConsumerState.Dead: set(),
+            ConsumerState.Rebalancing: set(),
+            ConsumerState.Joined: set()
+        }
 
         for node in self.nodes:
             node.version = version
 
     def _worker(self, idx, node):
         if node not in self.event_handlers:
-            self.event_handlers[node] = ConsumerEventHandler(node)
+            self.event_handlers[node] = ConsumerEventHandler(node, self.validate)
 
         handler = self.event_handlers[node]
+        with self.lock:
+            self._update_node_state(node, handler)
         node.account.ssh("mkdir -p %s" % VerifiableConsumer.PERSISTENT_ROOT, allow_fail=False)
 
         # Create and upload log properties
@@ -178,50 +263,185 @@ class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
         cmd = self.start_cmd(node)
         self.logger.debug("VerifiableConsumer %d command: %s" % (idx, cmd))
 
-        for line in node.account.ssh_capture(cmd):
-            event = self.try_parse_json(line.strip())
+        # Dispatch table mapping each event name to the per-node handler and,
+        # where one exists, the updater for the group-wide state. A single dict
+        # lookup replaces the chain of string comparisons that ran on every
+        # event (which also compared shutdown_complete events twice).
+        dispatch = {
+            "shutdown_complete": (handler.handle_shutdown_complete, None),
+            "offsets_committed": (handler.handle_offsets_committed, self._update_global_committed),
+            "records_consumed": (handler.handle_records_consumed, self._update_global_position),
+            "partitions_revoked": (handler.handle_partitions_revoked, None),
+            "partitions_assigned": (handler.handle_partitions_assigned, None)
+        }
+
+        # Reading the ssh stream is network bound while parsing is CPU bound,
+        # so the two are overlapped: a reader thread drains ssh_capture into a
+        # bounded queue while this thread parses and dispatches. The bound
+        # backpressures the reader if the dispatcher ever falls behind.
+        # The dispatch keys are source literals, which CPython interns at
+        # compile time, so each probe below compares the cached hash and at
+        # most a few bytes of the incoming name; binding the lookup method to
+        # a local avoids re-creating it per event.
+        get_handlers = dispatch.get
+        lock = self.lock
+        line_queue = Queue(maxsize=1024)
+
+        # abandon tells the reader to stop if dispatch fails; reader_error
+        # carries any exception out of the reader so _worker can re-raise it
+        # where ducktape records worker errors; a bare daemon-thread death
+        # would otherwise look like a clean EOF and surface only as some
+        # unrelated wait_until timeout later in the test
+        abandon = threading.Event()
+        reader_error = []
+
+        def read_lines():
+            try:
+                for line in node.account.ssh_capture(cmd):
+                    if abandon.is_set():
+                        break
+                    line_queue.put(line)
+            except Exception as e:
+                reader_error.append(e)
+            finally:
+                line_queue.put(None)
+
+        reader = threading.Thread(target=read_lines, name="verifiable-consumer-reader-%d" % idx)
+        reader.daemon = True
+        reader.start()
+
+        done = False
+        try:
+            while not done:
+                # Block for one line, then greedily drain whatever else has
+                # already arrived so an entire backlog is parsed off the lock
+                # and applied under a single lock acquisition. Only lines that
+                # were already received are batched, so no event is ever held
+                # back while a test polls for it.
+                batch = [line_queue.get()]
+                try:
+                    while len(batch) < 64:
+                        batch.append(line_queue.get_nowait())
+                except Empty:
+                    pass
+
+                if batch[-1] is None:
+                    # the reader enqueues None last, once the stream has closed
+                    done = True
+                    batch.pop()
+
+                events = list(self._parse_events(batch))
+                if not events:
+                    continue
+
+                with lock:
+                    for event in events:
+                        handlers = get_handlers(event["name"])
+                        if handlers is not None:
+                            node_handler, global_handler = handlers
+                            node_handler(event)
+                            if global_handler is not None:
+                                global_handler(event)
+                    self._update_node_state(node, handler)
+                    # assigned_count only ever grows, so checking once per batch
+                    # keeps the group-wide rebalance count current
+                    if handler.assigned_count > self._max_assigned_count:
+                        self._max_assigned_count = handler.assigned_count
+        finally:
+            if not done:
+                # dispatch raised; without this the reader could stay parked
+                # forever on put() against a full queue, holding the ssh
+                # channel open for the rest of the suite. Telling it to stop
+                # and draining the queue frees the slot it is waiting for.
+                abandon.set()
+                try:
+                    while True:
+                        line_queue.get_nowait()
+                except Empty:
+                    pass
+
+        reader.join()
+        if reader_error:
+            # surface the root cause (e.g. RemoteCommandError from a failed
+            # start command) through ducktape's worker error handling
+            raise reader_error[0]
+
+    def _update_node_state(self, node, handler):
+        """Move the node into the state bucket matching its handler. Must be
+        called with self.lock held."""
+        for nodes in self._nodes_by_state.values():
+            nodes.discard(node)
+        self._nodes_by_state[handler.state].add(node)
+
+    def _parse_events(self, lines):
+        """Generate the consumer events found in a batch of output lines.
+
+        All stripping and JSON parsing happens here, before the dispatch loop
+        takes self.lock, so the lock is held only while mutating state.
+        """
+        try_parse_json = self.try_parse_json
+        for line in lines:
+            # rstrip only has to scan the line terminator, unlike strip()
+            # which walks whitespace from both ends of every line
+            raw = line.rstrip("\r\n")
+            # events are always JSON objects, so anything not starting with
+            # '{' (blank lines, interleaved log4j output) can be dropped
+            # without paying for a raised and caught JSON parse error
+            if not raw or raw[0] != "{":
+                continue
+            event = try_parse_json(raw)
             if event is not None:
-                with self.lock:
-                    name = event["name"]
-                    if name == "shutdown_complete":
-                        handler.handle_shutdown_complete()
-                    if name == "offsets_committed":
-                        handler.handle_offsets_committed(event)
-                        self._update_global_committed(event)
-                    elif name == "records_consumed":
-                        handler.handle_records_consumed(event)
-                        self._update_global_position(event)
-                    elif name == "partitions_revoked":
-                        handler.handle_partitions_revoked(event)
-                    elif name == "partitions_assigned":
-                        handler.handle_partitions_assigned(event)
+                yield event
 
     def _update_global_position(self, consumed_event):
+        self._global_total_consumed += consumed_event["count"]
+        validate = self.validate
+        global_position = self.global_position
+        global_committed = self.global_committed
         for consumed_partition in consumed_event["partitions"]:
-            tp = TopicPartition(consumed_partition["topic"], consumed_partition["partition"])
-            if tp in self.global_committed:
+            topic = consumed_partition["topic"]
+            partition = consumed_partition["partition"]
+            min_offset = consumed_partition["minOffset"]
+
+            if validate:
                 # verify that the position never gets behind the current commit.
-                assert self.global_committed[tp] <= consumed_partition["minOffset"], \
-                    "Consumed position %d is behind the current committed offset %d" % (consumed_partition["minOffset"], self.global_committed[tp])
+                committed = _offset_lookup(global_committed, topic, partition)
+                if committed is not None and committed > min_offset:
+                    raise AssertionError("Consumed position %d is behind the current committed offset %d"
+                                         % (min_offset, committed))
 
             # the consumer cannot generally guarantee that the position increases monotonically
             # without gaps in the face of hard failures, so we only log a warning when this happens
-            if tp in self.global_position and self.global_position[tp] != consumed_partition["minOffset"]:
-                self.logger.warn("Expected next consumed offset of %d, but instead saw %d" %
-                                 (self.global_position[tp], consumed_partition["minOffset"]))
+            position = _offset_lookup(global_position, topic, partition)
+            if position is not None and position != min_offset:
+                self.logger.warn("Expected next consumed offset of %d, but instead saw %d",
+                                 position, min_offset)
 
-            self.global_position[tp] = consumed_partition["maxOffset"] + 1
+            _offset_store(global_position, topic, partition, consumed_partition["maxOffset"] + 1)
 
     def _update_global_committed(self, commit_event):
         if commit_event["success"]:
+            validate = self.validate
+            global_position = self.global_position
+            global_committed = self.global_committed
             for offset_commit in commit_event["offsets"]:
-                tp = TopicPartition(offset_commit["topic"], offset_commit["partition"])
+                topic = offset_commit["topic"]
+                partition = offset_commit["partition"]
                 offset = offset_commit["offset"]
-                assert self.global_position[tp] >= offset, \
-                    "committed offset is ahead of the current partition"
-                self.global_committed[tp] = offset
+                if validate:
+                    position = _offset_lookup(global_position, topic, partition)
+                    if position is None or position < offset:
+                        raise AssertionError("committed offset is ahead of the current partition")
+                _offset_store(global_committed, topic, partition, offset)
 
     def start_cmd(self, node):
+        # every input below is fixed for the lifetime of the service, so the
+        # command only needs to be assembled once per node, not on each
+        # (re)start
+        cmd = self._start_cmd_cache.get(node)
+        if cmd is not None:
+            return cmd
+
         cmd = ""
         cmd += "export LOG_DIR=%s;" % VerifiableConsumer.LOG_DIR
         cmd += " export KAFKA_OPTS=%s;" % self.security_config.kafka_opts
@@ -235,7 +455,11 @@ class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
             cmd += " --max-messages %s" % str(self.max_messages)
 
         cmd += " --consumer.config %s" % VerifiableConsumer.CONFIG_FILE
-        cmd += " 2>> %s | tee -a %s &" % (VerifiableConsumer.STDOUT_CAPTURE, VerifiableConsumer.STDOUT_CAPTURE)
+        # stderr goes to its own capture file; stdout must stay on the ssh
+        # stream for _worker to consume, so it is tee'd to its capture file
+        # rather than redirected
+        cmd += " 2>> %s | tee -a %s &" % (VerifiableConsumer.STDERR_CAPTURE, VerifiableConsumer.STDOUT_CAPTURE)
+        self._start_cmd_cache[node] = cmd
         return cmd
 
     def pids(self, node):
@@ -251,7 +475,8 @@ class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
         try:
             return json.loads(string)
         except ValueError:
-            self.logger.debug("Could not parse as json: %s" % str(string))
+            # lazy formatting so the message is only built if DEBUG is enabled
+            self.logger.debug("Could not parse as json: %s", string)
             return None
 
     def stop_all(self):
@@ -266,7 +491,10 @@ class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
         for pid in self.pids(node):
             node.account.signal(pid, sig, allow_fail)
 
-        self.event_handlers[node].handle_kill_process(clean_shutdown)
+        with self.lock:
+            handler = self.event_handlers[node]
+            handler.handle_kill_process(clean_shutdown)
+            self._update_node_state(node, handler)
 
     def stop_node(self, node, clean_shutdown=True):
         self.kill_node(node, clean_shutdown=clean_shutdown)
@@ -282,47 +510,40 @@ class VerifiableConsumer(KafkaPathResolverMixin, BackgroundThreadService):
 
     def current_assignment(self):
         with self.lock:
-            return { handler.node: handler.current_assignment() for handler in self.event_handlers.itervalues() }
+            return { handler.node: handler.current_assignment() for handler in self.event_handlers.values() }
 
     def current_position(self, tp):
-        with self.lock:
-            if tp in self.global_position:
-                return self.global_position[tp]
-            else:
-                return None
+        # read-only query; the GIL makes the individual dict/list reads in
+        # _offset_lookup atomic, and the offset lists only ever grow, so
+        # there is no need to block the workers by taking the lock
+        return _offset_lookup(self.global_position, tp.topic, tp.partition)
 
     def owner(self, tp):
-        for handler in self.event_handlers.itervalues():
-            if tp in handler.current_assignment():
+        for handler in self.event_handlers.values():
+            if tp in handler.assignment:
                 return handler.node
         return None
 
     def last_commit(self, tp):
-        with self.lock:
-            if tp in self.global_committed:
-                return self.global_committed[tp]
-            else:
-                return None
+        # lock-free for the same reason as current_position
+        return _offset_lookup(self.global_committed, tp.topic, tp.partition)
 
     def total_consumed(self):
-        with self.lock:
-            return sum(handler.total_consumed for handler in self.event_handlers.itervalues())
+        # a single int load is atomic under the GIL; no lock needed
+        return self._global_total_consumed
 
     def num_rebalances(self):
         with self.lock:
-            return max(handler.assigned_count for handler in self.event_handlers.itervalues())
+            return self._max_assigned_count
 
     def joined_nodes(self):
         with self.lock:
-            return [handler.node for handler in self.event_handlers.itervalues()
-                    if handler.state == ConsumerState.Joined]
+            return list(self._nodes_by_state[ConsumerState.Joined])
 
     def rebalancing_nodes(self):
         with self.lock:
-            return [handler.node for handler in self.event_handlers.itervalues()
-                    if handler.state == ConsumerState.Rebalancing]
+            return list(self._nodes_by_state[ConsumerState.Rebalancing])
 
     def dead_nodes(self):
         with self.lock:
-            return [handler.node for handler in self.event_handlers.itervalues()
-                    if handler.state == ConsumerState.Dead]
+            return list(self._nodes_by_state[ConsumerState.Dead])